@@ -98,7 +98,8 @@ def animate_pendulum(t_span, xy, scale=1.0):
     Used this example :)
     matplotlib.org/gallery/animation/double_pendulum_animated_sgskip.html
     '''
-    assert 0.01 < scale < 100
+    if not 0.01 < scale < 100:
+        raise ValueError('scale must be between 0.01 and 100')
     dt = np.average(np.diff(t_span)) / scale
 
     figure = plt.figure()
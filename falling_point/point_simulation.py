@@ -1,13 +1,14 @@
-https://github.com/hirschmann/pid-autotune
-https://codereview.stackexchange.com/questions/155205/python-pid-simulator-controller-output
+# https://github.com/hirschmann/pid-autotune
+# https://codereview.stackexchange.com/questions/155205/python-pid-simulator-controller-output
 
 
+import argparse
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from mpl_toolkits.mplot3d import axes3d
 import numpy as np
-import scipy.integrate as integrate
+import os
 
 '''
 TODO
@@ -16,29 +17,63 @@ TODO
 # Set up constants
 MASS = 2                 # Mass (Kg)
 G = 9.8                  # Gravity acceleration (m/s**2)
-DRAG_COEFFICIENT = 0.1   # Something meaningless (see M_component_drag)
+DRAG_COEFFICIENT = 0.1   # Something meaningless (see falling_point_ode)
 SIM_LENGTH = 10          # Seconds
 SAMPLES_PER_SECOND = 30  # Used in the solver
 
 
-def main():
+def main(args):
     # Set up initial conditions
     position_0 = np.array([1.0,  1.5, 2.5])  # Initial (x, y, z) position (m)
     velocity_0 = np.array([0.0, -0.1, 0.5])  # Initial (x, y, z) velocity (m/s)
-    initial = np.hstack((position_0, velocity_0))
     t_span = np.linspace(0, SIM_LENGTH, SIM_LENGTH * SAMPLES_PER_SECOND)
 
-    # Run the initial conditions through the ODE
-    parameters = integrate.odeint(falling_point_ode, initial, t_span)
+    # Evaluate the closed-form solution of the ODE over the whole time span
+    parameters = falling_point_trajectory(position_0, velocity_0, t_span)
 
     # Play back the results
-    animate_point(t_span, parameters[:, 0:3])
+    if args.save_animation is not None:
+        # Nothing is shown, so skip setting up an interactive backend
+        plt.switch_backend('Agg')
+        animate_point(t_span, parameters[:, 0:3],
+                      save_path=args.save_animation)
+    elif not args.no_plot:
+        animate_point(t_span, parameters[:, 0:3])
+
+
+def falling_point_trajectory(position_0, velocity_0, t_span):
+    '''
+    Closed-form solution of falling_point_ode while thrust is zero. With
+    linear drag the velocity decays exponentially towards the terminal
+    velocity, so the whole trajectory can be evaluated in one broadcast
+    instead of stepping an integrator.
+
+    Returns an (N, 6) array of [x, y, z, x_dot, y_dot, z_dot] for each of the
+    N times in t_span
+    '''
+    t = t_span[:, None]
+    gravity = np.array([0.0, 0.0, -G])
+    zout = np.empty((t_span.size, 6))
+    if DRAG_COEFFICIENT == 0:
+        zout[:, 0:3] = position_0 + velocity_0 * t + 0.5 * gravity * t * t
+        zout[:, 3:6] = velocity_0 + gravity * t
+    else:
+        terminal_velocity = gravity / DRAG_COEFFICIENT
+        decay = np.exp(-DRAG_COEFFICIENT * t)
+        zout[:, 0:3] = position_0 + terminal_velocity * t +\
+            (velocity_0 - terminal_velocity) * (1.0 - decay) / DRAG_COEFFICIENT
+        zout[:, 3:6] = terminal_velocity +\
+            (velocity_0 - terminal_velocity) * decay
+    return zout
 
 
 def falling_point_ode(parameters, t):
     '''
     TODO
 
+    Kept for when thrust gets a strategy, at which point
+    falling_point_trajectory no longer applies and this has to be integrated
+
     p_dot = M * p, where M is a matrix of the form
 
     x_dot       [0      0      0      1    0    0    0      ]   x
@@ -50,63 +85,35 @@ def falling_point_ode(parameters, t):
                                                                 1
     '''
 
-    RHS_vector = np.hstack((parameters, 1.0))
-    M = M_component_velocity(parameters) +\
-        M_component_gravity(parameters) +\
-        M_component_drag(parameters) +\
-        M_component_thrust(parameters)
-    parameters_dot = M.dot(RHS_vector)
-    return parameters_dot
-
-
-def M_component_empty(parameters):
-    return np.zeros((len(parameters), len(parameters) + 1))
-
-
-def M_component_velocity(parameters):
-    matrix = M_component_empty(parameters)
-    matrix[0, 3] = 1.0
-    matrix[1, 4] = 1.0
-    matrix[2, 5] = 1.0
-    return matrix
-
-
-def M_component_gravity(parameters):
-    matrix = M_component_empty(parameters)
-    matrix[5, 6] = -G
-    return matrix
-
-
-def M_component_drag(parameters):
-    '''
-    Represents drag as a linear term
-    '''
-    # Drag should really be a squared term:
+    # Fill in the rows of M * p directly rather than summing matrices, so
+    # each call makes a single small allocation
+    parameters_dot = np.empty(6)
+    parameters_dot[0] = parameters[3]
+    parameters_dot[1] = parameters[4]
+    parameters_dot[2] = parameters[5]
+    # Drag is represented as a linear term. It should really be a squared term:
     # http://www.softschools.com/formulas/physics/air_resistance_formula/85/
     # TODO: Look up how to do that correctly
-    matrix = M_component_empty(parameters)
-    matrix[3, 3] = -DRAG_COEFFICIENT
-    matrix[4, 4] = -DRAG_COEFFICIENT
-    matrix[5, 5] = -DRAG_COEFFICIENT
-    return matrix
-
-
-def M_component_thrust(parameters):
-    '''
-    TODO: Decide on strategy
-    '''
-    return M_component_empty(parameters)
+    # TODO: Decide on a thrust strategy, for now it is zero
+    parameters_dot[3] = -DRAG_COEFFICIENT * parameters[3]
+    parameters_dot[4] = -DRAG_COEFFICIENT * parameters[4]
+    parameters_dot[5] = -DRAG_COEFFICIENT * parameters[5] - G
+    return parameters_dot
 
 
-def animate_point(t_span, xyz, scale=1.0):
+def animate_point(t_span, xyz, scale=1.0, save_path=None):
     '''
     Takes the points in time ((N,) array) and the (x, y, z) points of the mass
     ((N, 3) array) and creates a plot that shows the point motion.
 
     scale is a float that will scale the playback speed. At 2 the playback will
     happen at twice the actual speedl
+
+    If save_path is given the animation is written there with ffmpeg instead
+    of being shown
     '''
-    assert 0.01 < scale < 100
+    if not 0.01 < scale < 100:
+        raise ValueError('scale must be between 0.01 and 100')
     dt = np.average(np.diff(t_span)) / scale
 
     # Attaching 3D axis to the figure
@@ -116,27 +123,40 @@ def animate_point(t_span, xyz, scale=1.0):
     # Setting the axes properties
     axes.set_aspect('equal')
     axes.grid()
-    axes.set_xlim3d([min(np.min(xyz[:, 0]), -1), max(np.max(xyz[:, 0]), 1)])
-    axes.set_ylim3d([min(np.min(xyz[:, 1]), -1), max(np.max(xyz[:, 1]), 1)])
-    axes.set_zlim3d([min(np.min(xyz[:, 2]), -1), max(np.max(xyz[:, 2]), 1)])
+    # Reduce all three columns at once, keeping at least [-1, 1] on each axis
+    lower = np.minimum(xyz.min(axis=0), -1.0)
+    upper = np.maximum(xyz.max(axis=0), 1.0)
+    axes.set_xlim3d([lower[0], upper[0]])
+    axes.set_ylim3d([lower[1], upper[1]])
+    axes.set_zlim3d([lower[2], upper[2]])
     axes.view_init(elev=0.0, azim=0.0)
     axes.set_xlabel('X')
     axes.set_ylabel('Y')
     axes.set_zlabel('Z')
 
-    point, = axes.plot([0.0], [0.0], [0.0], 'o', markersize=MASS * 10)
+    # Contiguous per-axis copies, so each frame can hand a 1-element slice to
+    # the point instead of boxing scalars into new lists
+    x = np.ascontiguousarray(xyz[:, 0])
+    y = np.ascontiguousarray(xyz[:, 1])
+    z = np.ascontiguousarray(xyz[:, 2])
+
+    # The point and the text are the only artists that change, they are
+    # created once and then updated in place each frame
+    point, = axes.plot([], [], [], 'o', markersize=MASS * 10)
     time_text = axes.text(0.9, 0.9, 0.9, '', transform=axes.transAxes)
+    # Format every frame's label up front, out of the render path
+    time_labels = ['time={:.1f}s'.format(i * dt) for i in range(xyz.shape[0])]
 
     def initialize_animation():
-        point.set_data([0.0], [0.0])
-        point.set_3d_properties([0.0])
+        point.set_data([], [])
+        point.set_3d_properties([])
         time_text.set_text('')
         return point, time_text
 
     def animate(i):
-        point.set_data(xyz[i, 0], xyz[i, 1])
-        point.set_3d_properties(xyz[i, 2])
-        time_text.set_text('time={:.1f}s'.format(i * dt))
+        point.set_data(x[i:i + 1], y[i:i + 1])
+        point.set_3d_properties(z[i:i + 1])
+        time_text.set_text(time_labels[i])
         return point, time_text
 
     pendulumAnimation = animation.FuncAnimation(
@@ -144,10 +164,28 @@ def animate_point(t_span, xyz, scale=1.0):
         animate,
         np.arange(1, xyz.shape[0]),
         interval=int(dt * 1e3),
+        blit=True,
         init_func=initialize_animation)
 
-    plt.show()
+    if save_path is None:
+        plt.show()
+    else:
+        pendulumAnimation.save(save_path, writer='ffmpeg',
+                               fps=max(1, round(1 / dt)))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--no-plot',
+        action='store_true',
+        default=bool(os.environ.get('SIM_NO_PLOT')),
+        help='only run the simulation, skipping the animation (also set by a'
+             ' non-empty SIM_NO_PLOT environment variable)')
+    parser.add_argument(
+        '--save-animation',
+        metavar='PATH',
+        default=None,
+        help='write the animation to PATH (e.g. out.mp4) with ffmpeg instead'
+             ' of showing it')
+    main(parser.parse_args())
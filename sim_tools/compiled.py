@@ -0,0 +1,149 @@
+'''
+numba compiled versions of the simulate_system loop, for plants that support
+it. Importing this module needs numba, so sim.py only imports it for runs long
+enough to be worth it.
+
+The arithmetic here is copied from PIDArduino.calc and the plant update
+methods. After changing either side run sim.py with --check-compiled, which
+runs both loops and compares their histories.
+'''
+
+import numpy as np
+from numba import njit
+
+from plant import Kettle
+
+# numba can't read class attributes, so mirror the ones kettle_step needs
+_SPECIFIC_HEAT_CAP_WATER = Kettle.SPECIFIC_HEAT_CAP_WATER
+_THERMAL_CONDUCTIVITY_STEEL = Kettle.THERMAL_CONDUCTIVITY_STEEL
+
+
+@njit(cache=True)
+def pid_calc(params, state, timestamp, input_val, setpoint,
+             max_allowable_change):
+    '''
+    Compiled copy of PIDArduino.calc, operating on the arrays from
+    PIDArduino.step_kernel. Updates state in place and returns the output
+    '''
+    kp = params[0]
+    ki = params[1]
+    kd = params[2]
+    sampletime = params[3]
+    out_min = params[4]
+    out_max = params[5]
+    now = timestamp * 1000
+
+    if (now - state[3]) < sampletime:
+        return state[2]
+
+    # Compute all the working error variables
+    error = setpoint - input_val
+    input_diff = input_val - state[1]
+
+    # In order to prevent windup, only integrate if the process is not
+    # saturated
+    integral = state[0]
+    if state[2] < out_max and state[2] > out_min:
+        integral += ki * error
+        integral = min(integral, out_max)
+        integral = max(integral, out_min)
+
+    p = kp * error
+    i = integral
+    d = -(kd * input_diff)
+
+    # Compute PID Output
+    previous_output = state[2]
+    output = p + i + d
+    # Put limits on the output signal
+    output = min(output, out_max)
+    output = max(output, out_min)
+    # Make sure the change isn't too abrupt
+    delta_output = output - previous_output
+    if abs(delta_output) > max_allowable_change:
+        output = previous_output + np.sign(delta_output) * max_allowable_change
+
+    # Remember some variables for next time
+    state[0] = integral
+    state[1] = input_val
+    state[2] = output
+    state[3] = now
+    return output
+
+
+@njit(cache=True)
+def kettle_step(state, params, output, duration):
+    '''
+    Compiled copy of Kettle.update (including _heat, _cool and _get_deltaT),
+    operating on the arrays from Kettle.step_kernel. Updates state in place
+    and returns the new sensable state
+    '''
+    mass = params[0]
+    heater_power = params[1]
+    ambient_temp = params[2]
+    heat_loss_factor = params[3]
+    surface = params[4]
+    temp = state[0]
+
+    # Heat with an efficiency of 0.98
+    power = (output / 100) * heater_power
+    temp += ((power * 0.98) * duration) / (_SPECIFIC_HEAT_CAP_WATER * mass)
+
+    # Cool, with the power converted from W to kW
+    power = ((_THERMAL_CONDUCTIVITY_STEEL * surface
+             * (temp - ambient_temp)) / duration)
+    power /= 1000
+    temp -= (((power * duration) / (_SPECIFIC_HEAT_CAP_WATER * mass))
+             * heat_loss_factor)
+
+    state[0] = temp
+    return temp
+
+
+@njit(cache=True)
+def run_kettle_loop(end_time, sampletime, setpoint, allowable_change,
+                    supress_output, sensor_noise, delayed_states, pid_params,
+                    pid_state, plant_state, plant_params, timestamps,
+                    plant_states, sensor_states, outputs):
+    '''
+    Compiled copy of the simulate_system loop for Kettle. The plant step is
+    called directly rather than passed in, because numba can't cache a
+    function that takes another compiled function as an argument. Fills in
+    the history arrays, the delayed_states ring buffer and the state arrays
+    in place and returns the number of steps run
+    '''
+    delayed_samples_len = delayed_states.shape[0]
+    delayed_head = 0
+    timestamp = 0.0
+    i = 0
+    while timestamp < end_time:
+        timestamp += sampletime
+
+        sensor_state = delayed_states[delayed_head] + sensor_noise[i]
+
+        # Calculates controller reaction
+        if supress_output:
+            output = 0.0
+        else:
+            output = pid_calc(pid_params, pid_state, timestamp, sensor_state,
+                              setpoint, allowable_change)
+
+        # Calculates the effects of the controller output on the next sensor
+        # reading, then runs it through the delayed_states ring buffer
+        plant_state_now = kettle_step(plant_state, plant_params, output,
+                                      sampletime)
+        delayed_states[delayed_head] = plant_state_now
+        delayed_head = (delayed_head + 1) % delayed_samples_len
+        sensor_states[i] = delayed_states[delayed_head]
+        timestamps[i] = timestamp
+        outputs[i] = output
+        plant_states[i] = plant_state_now
+        i += 1
+    return i
+
+
+# The compiled loop for each plant class name in plant.py that has one, keep
+# sim.COMPILED_PLANTS in step with the keys
+LOOPS = {
+    'Kettle': run_kettle_loop,
+}
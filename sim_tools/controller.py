@@ -44,6 +44,24 @@ class PIDArduino(object):
         self._last_calc_timestamp = 0
         self._time = time
 
+    def step_kernel(self):
+        """Returns (state, params) arrays for running the controller with
+        compiled.pid_calc, where state is [integral, last_input, last_output,
+        last_calc_timestamp] and params is [Kp, Ki, Kd, sampletime, out_min,
+        out_max], with the coefficients and sampletime scaled like in calc().
+        Write the state back with load_kernel_state when done.
+        """
+        state = np.array([self._integral, self._last_input,
+                          self._last_output, self._last_calc_timestamp],
+                         dtype=np.float64)
+        params = np.array([self._Kp, self._Ki, self._Kd, self._sampletime,
+                           self._out_min, self._out_max], dtype=np.float64)
+        return state, params
+
+    def load_kernel_state(self, state):
+        (self._integral, self._last_input, self._last_output,
+         self._last_calc_timestamp) = (float(value) for value in state)
+
     def calc(self, input_val, setpoint, max_allowable_change):
         """Adjusts and holds the given setpoint.
 
@@ -85,11 +103,13 @@ class PIDArduino(object):
             self._last_output = previous_output + \
                                 np.sign(delta_output) * max_allowable_change
 
-        # Log some debug info
-        self._logger.debug('P: {0}'.format(p))
-        self._logger.debug('I: {0}'.format(i))
-        self._logger.debug('D: {0}'.format(d))
-        self._logger.debug('output: {0}'.format(self._last_output))
+        # Log some debug info, checking first so the messages are only
+        # formatted when they will be shown
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug('P: {0}'.format(p))
+            self._logger.debug('I: {0}'.format(i))
+            self._logger.debug('D: {0}'.format(d))
+            self._logger.debug('output: {0}'.format(self._last_output))
 
         # Remember some variables for next time
         self._last_input = input_val
@@ -1,3 +1,4 @@
+from collections import namedtuple
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
 import numpy as np
@@ -8,6 +9,25 @@ import scipy.integrate as integrate
 _G = 9.8
 
 
+# Each plant takes its initial and constant values as one of these records,
+# so the set of names is fixed and every value can be read by attribute (or
+# index, e.g. from numba) instead of by looking up string keys in a dict
+KettleInitial = namedtuple('KettleInitial', ['kettle_temp'], defaults=[40.0])
+KettleConstants = namedtuple(
+    'KettleConstants',
+    ['volume', 'density', 'heater_power', 'ambient_temp', 'heat_loss_factor',
+     'diameter'],
+    defaults=[70.0, 1.0, 6.0, 20.0, 1.0, 50.0])
+InvertedPendulumInitial = namedtuple(
+    'InvertedPendulumInitial',
+    ['x0', 'x_dot0', 'theta0', 'theta_dot0'],
+    defaults=[0.0, 0.0, 0.0, 0.0])
+InvertedPendulumConstants = namedtuple(
+    'InvertedPendulumConstants',
+    ['length', 'mass'],
+    defaults=[1.0, 0.25])
+
+
 class Kettle(object):
     """
     A simulated brewing kettle.
@@ -28,18 +48,21 @@ class Kettle(object):
     # thermal conductivity of steel: lambda = 15 W / m * K
     THERMAL_CONDUCTIVITY_STEEL = 15
 
+    Initial = KettleInitial
+    Constants = KettleConstants
+
     def __init__(self, initial, constants):
 
-        self._temp = initial.get('kettle_temp', 40.0)
+        self._temp = initial.kettle_temp
 
-        volume = constants.get('volume', 70.0)
-        self._mass = (volume * constants.get('density', 1.0))
-        self._heater_power = constants.get('heater_power', 6.0)
-        self._ambient_temp = constants.get('ambient_temp', 20.0)
-        self._heat_loss_factor = constants.get('heat_loss_factor', 1.0)
+        volume = constants.volume
+        self._mass = (volume * constants.density)
+        self._heater_power = constants.heater_power
+        self._ambient_temp = constants.ambient_temp
+        self._heat_loss_factor = constants.heat_loss_factor
 
         # radius in cm
-        radius = constants.get('diameter', 50.0) / 2
+        radius = constants.diameter / 2
         # height in cm
         height = (volume * 1000) / (np.pi * np.power(radius, 2))
         # surface in m^2
@@ -52,6 +75,21 @@ class Kettle(object):
         """
         return self._temp
 
+    def step_kernel(self):
+        '''
+        Returns (state, params) arrays for stepping the kettle with
+        compiled.kettle_step, where state is [temp] and params is [mass,
+        heater_power, ambient_temp, heat_loss_factor, surface]. Write the state
+        back with load_kernel_state when done
+        '''
+        state = np.array([self._temp])
+        params = np.array([self._mass, self._heater_power, self._ambient_temp,
+                           self._heat_loss_factor, self._surface])
+        return state, params
+
+    def load_kernel_state(self, state):
+        self._temp = float(state[0])
+
     def update(self, output, duration):
         '''
         Update the internal state of the kettle based on the controller output
@@ -117,21 +155,27 @@ class InvertedPendulum(object):
         theta_dot0: Initial arm angular velocity (rad/s)
     """
 
+    Initial = InvertedPendulumInitial
+    Constants = InvertedPendulumConstants
+
     def __init__(self, initial, constants):
-        self._length = constants.get('length', 1.0)
-        self._mass = constants.get('mass', 0.25)
-        self._x = initial.get('x0', 0.0)
-        self._x_dot = initial.get('x_dot0', 0.0)
-        self._theta = initial.get('theta0', 0.0)
-        self._theta_dot = initial.get('theta_dot0', 0.0)
+        self._length = constants.length
+        self._mass = constants.mass
+        self._x = initial.x0
+        self._x_dot = initial.x_dot0
+        self._theta = initial.theta0
+        self._theta_dot = initial.theta_dot0
         self._elapsed_time = 0.0
-        self._state_history = np.array([[
+        # Blocks of [t, x, x_dot, theta, theta_dot] rows, one per update. They
+        # are only stacked when plotted, growing a single array on every
+        # update would copy the whole history each time
+        self._state_history = [np.array([[
             self._elapsed_time,
             self._x,
             self._x_dot,
             self._theta,
             self._theta_dot,
-        ]])
+        ]])]
 
     @property
     def sensable_state(self):
@@ -164,9 +208,12 @@ class InvertedPendulum(object):
             t=t_span,
             args=(acceleration, )
         )
-        # Save the state history as fine-grain as possible
-        self._save_state(np.hstack((t_span.reshape(t_span.shape[0], 1),
-                                    updated_state_vector)))
+        # Save the state history as fine-grain as possible, writing the times
+        # and states into one block rather than stacking them
+        updated_state_vector_w_time = np.empty((t_span.shape[0], 5))
+        updated_state_vector_w_time[:, 0] = t_span
+        updated_state_vector_w_time[:, 1:] = updated_state_vector
+        self._save_state(updated_state_vector_w_time)
         # Set the current state
         self._elapsed_time = t_span[-1]
         self._x, self._x_dot, self._theta, self._theta_dot = updated_state_vector[-1]
@@ -175,7 +222,7 @@ class InvertedPendulum(object):
         '''
         Plots the available state variables in _state_history
         '''
-        history = self._state_history.copy()
+        history = np.vstack(self._state_history)
         fig, axes = plt.subplots(2)
         axes[0].plot(history[:, 0], history[:, 1], label='cart x')
         axes[0].plot(history[:, 0], history[:, 2], label='cart x_dot')
@@ -196,7 +243,7 @@ class InvertedPendulum(object):
         constant if the cart is not moving, and is a good check of the pendulum
         simulation
         '''
-        history = self._state_history.copy()
+        history = np.vstack(self._state_history)
         # Potential energy = m * g * cos(theta) * L
         PE = self._mass * _G * self._length * np.cos(history[:, 3])
         # Kinetic energy = (1/2) * m * (L * theta_dot)^2
@@ -219,7 +266,7 @@ class InvertedPendulum(object):
         downsample = 50
         scaling = 0.5
 
-        history = self._state_history.copy()
+        history = np.vstack(self._state_history)
 
         t_span = history[::downsample, 0]
         dt = np.average(np.diff(t_span)) * scaling
@@ -269,8 +316,7 @@ class InvertedPendulum(object):
         plt.show()
 
     def _save_state(self, updated_state_vector_w_time):
-        self._state_history = np.vstack((self._state_history,
-                                         updated_state_vector_w_time))
+        self._state_history.append(updated_state_vector_w_time)
 
     def _pendulum_ode(self, state_vector, t, command_x_ddot):
         '''
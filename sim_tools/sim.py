@@ -1,10 +1,13 @@
 import argparse
 from ast import literal_eval
-from collections import deque, namedtuple
+from collections import namedtuple
+from functools import partial
 import logging
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+from operator import getitem
+import os
 import sys
 
 from controller import PIDArduino
@@ -17,101 +20,250 @@ Simulation = namedtuple(
      'plant_states', 'sensor_states', 'outputs'])
 
 
+# The plant class names that have a loop in compiled.LOOPS. Kept here so
+# other plants don't import numba just to find out they have none
+COMPILED_PLANTS = {'Kettle'}
+# Runs shorter than this stay in the Python loop. Importing numba and loading
+# the compiled loop from its cache costs a fixed ~0.3-0.45s, while the Python
+# loop costs ~2.5us per step, so the compiled loop only wins reliably from
+# about 250k steps on (with or without --supress-output)
+COMPILED_MIN_STEPS = 250000
+
+
 def simulate_system(args):
+    if args.check_compiled:
+        sim = check_compiled(args)
+    else:
+        sim = run_simulation(args)
+
+    if args.no_plot:
+        return
+
+    title = '{} simulation, {:.1f}s delay, {:.1f}s sampletime'.format(
+        sim.name, args.delay, args.sampletime
+    )
+    plot_simulation(sim, title)
+
+    # Do if implemented for this plant
+    try:
+        sim.plant.plot_state_history()
+    except AttributeError:
+        pass
+    try:
+        sim.plant.plot_energy()
+    except AttributeError:
+        pass
+    try:
+        sim.plant.animate_system()
+    except AttributeError:
+        pass
+
+
+def run_simulation(args, use_compiled=None):
+    '''
+    Runs the simulation described by args and returns the Simulation. Plants
+    with a loop in compiled.py run it when use_compiled is True, or by default
+    when the run has at least COMPILED_MIN_STEPS steps and isn't verbose (the
+    controller logs its terms each step, which the compiled loop can't do)
+    '''
     timestamp = 0  # seconds
+    # Holds the timestamp for the controller's time function to read. Reading
+    # it through partial and getitem stays in C, where a lambda over
+    # timestamp would run a Python frame on every calc()
+    clock = [0.0]
     delayed_samples_len = max(1, round(args.delay / args.sampletime))
+    # Number of simulation steps, with one spare because the loop below
+    # accumulates floating point timestamps and can run one step over
+    steps = int(np.ceil(args.interval * 60 / args.sampletime)) + 1
 
-    assert hasattr(plant, args.plant)
+    if not hasattr(plant, args.plant):
+        raise ValueError('plant.py has no plant {}'.format(args.plant))
     plantClass = getattr(plant, args.plant)
 
     initial = literal_eval(args.initial_values)
-    assert isinstance(initial, dict)
+    if not isinstance(initial, dict):
+        raise ValueError('--initial-values must be a dictionary')
+    initial = plant_values(plantClass.Initial, initial, '--initial-values')
     constants = literal_eval(args.constant_values)
-    assert isinstance(constants, dict)
+    if not isinstance(constants, dict):
+        raise ValueError('--constant-values must be a dictionary')
+    constants = plant_values(plantClass.Constants, constants,
+                             '--constant-values')
 
     # Create a simulation for the tuple pid(kp, ki, kd)
     sim = Simulation(
         name='{} PID'.format(args.plant),
         controller=PIDArduino(
             sampletime=args.sampletime,
-            kp=float(args.pid[0]),
-            ki=float(args.pid[1]),
-            kd=float(args.pid[2]),
+            kp=args.pid[0],
+            ki=args.pid[1],
+            kd=args.pid[2],
             out_min=args.out_min,
             out_max=args.out_max,
-            time=lambda: timestamp),
+            time=partial(getitem, clock, 0)),
         plant=plantClass(initial, constants),
-        delayed_states=deque(maxlen=delayed_samples_len),
-        timestamps=[],
-        plant_states=[],
-        sensor_states=[],
-        outputs=[],
+        delayed_states=np.empty(delayed_samples_len, dtype=np.float64),
+        timestamps=np.empty(steps, dtype=np.float64),
+        plant_states=np.empty(steps, dtype=np.float64),
+        sensor_states=np.empty(steps, dtype=np.float64),
+        outputs=np.empty(steps, dtype=np.float64),
     )
 
-    # Init delayed_states deque for each simulation
-    sim.delayed_states.extend(
-        sim.delayed_states.maxlen * [sim.plant.sensable_state]
-    )
+    # Init delayed_states ring buffer for each simulation. delayed_head is
+    # the index of the oldest element, which is the one the sensor reads
+    sim.delayed_states.fill(sim.plant.sensable_state)
+    delayed_head = 0
 
     # Calculate the allowable output change in a single step
     allowable_change = args.output_rate_limit * args.sampletime
 
+    # Make noise centered around 0 w/ a given stddev for every step at once
+    if args.sensor_noise_std_dev <= 0.0:
+        sensor_noise = np.zeros(steps)
+    else:
+        sensor_noise = np.random.normal(scale=args.sensor_noise_std_dev,
+                                        size=steps)
+
     # Run simulation for specified interval. The (x60) is because args.interval
     # is in minutes and we want seconds
-    while timestamp < (args.interval * 60):
-        timestamp += args.sampletime
-
-        # Make noise centered around 0 w/ a given stddev
-        if args.sensor_noise_std_dev <= 0.0:
-            sensor_noise = 0.0
-        else:
-            sensor_noise = np.random.normal(scale=args.sensor_noise_std_dev)
-        sensor_state = sim.delayed_states[0] + sensor_noise
-
-        # Calculates controller reaction
+    end_time = args.interval * 60
+
+    if use_compiled is None:
+        use_compiled = steps >= COMPILED_MIN_STEPS and not args.verbose
+    loop = compiled_loop(args.plant) if use_compiled else None
+    if loop is not None:
+        # The compiled loop keeps the ring buffer head and the controller
+        # and plant states to itself, then they get written back
+        pid_state, pid_params = sim.controller.step_kernel()
+        plant_state, plant_params = sim.plant.step_kernel()
+        # Everything is passed as float64 so the cached compilation always
+        # matches
+        i = loop(float(end_time), float(args.sampletime),
+                 float(args.setpoint), float(allowable_change),
+                 bool(args.supress_output), sensor_noise, sim.delayed_states,
+                 pid_params, pid_state, plant_state, plant_params,
+                 sim.timestamps, sim.plant_states, sim.sensor_states,
+                 sim.outputs)
+        sim.controller.load_kernel_state(pid_state)
+        sim.plant.load_kernel_state(plant_state)
+    else:
+        # Bind everything the loop touches to locals up front, so each step
+        # avoids repeated attribute lookups and branches on args
+        dt = args.sampletime
+        setpoint = args.setpoint
+        sim_plant = sim.plant
+        update = sim_plant.update
+        delayed_states = sim.delayed_states
+        timestamps = sim.timestamps
+        plant_states = sim.plant_states
+        sensor_states = sim.sensor_states
+        outputs = sim.outputs
         if args.supress_output:
-            output = 0.0
+            # Always output 0.0 so the system settles to its steady state
+            def calc(input_val, setpoint, max_allowable_change):
+                return 0.0
         else:
-            # Calculate the next desired output
-            output = sim.controller.calc(input_val=sensor_state,
-                                         setpoint=args.setpoint,
-                                         max_allowable_change=allowable_change)
+            calc = sim.controller.calc
 
-        # Calculates the effects of the controller output on the next sensor
-        # reading
-        simulation_update(sim, timestamp, output, args)
+        i = 0
+        while timestamp < end_time:
+            timestamp += dt
+            clock[0] = timestamp
 
-    title = '{} simulation, {:.1f}s delay, {:.1f}s sampletime'.format(
-        sim.name, args.delay, args.sampletime
-    )
-    plot_simulation(sim, title)
+            # item() reads Python floats, indexing would hand the controller
+            # numpy scalars, which are slower to do arithmetic on
+            sensor_state = (delayed_states.item(delayed_head) +
+                            sensor_noise.item(i))
 
-    # Do if implemented for this plant
-    try:
-        sim.plant.plot_state_history()
-    except AttributeError:
-        pass
-    try:
-        sim.plant.plot_energy()
-    except AttributeError:
-        pass
+            # Calculate the next desired output
+            output = calc(input_val=sensor_state,
+                          setpoint=setpoint,
+                          max_allowable_change=allowable_change)
+
+            # Calculates the effects of the controller output on the next
+            # sensor reading
+            update(output, duration=dt)
+            plant_state = sim_plant.sensable_state
+            # Overwrite the oldest element of the delayed_states ring buffer
+            # with a state reading, which makes the next element the oldest
+            delayed_states[delayed_head] = plant_state
+            delayed_head = (delayed_head + 1) % delayed_samples_len
+            # Make the simulation read the delayed state value
+            sensor_states[i] = delayed_states[delayed_head]
+            # For the following values just record them as step i of the values
+            # over time
+            timestamps[i] = timestamp
+            outputs[i] = output
+            plant_states[i] = plant_state
+            i += 1
+
+    # Drop the unused spare step, if there is one
+    sim = sim._replace(
+        timestamps=sim.timestamps[:i],
+        plant_states=sim.plant_states[:i],
+        sensor_states=sim.sensor_states[:i],
+        outputs=sim.outputs[:i],
+    )
+    return sim
+
+
+def plant_values(record, values, option):
+    '''
+    Builds the given plant Initial or Constants record from a dictionary of
+    values, as floats. Names the record doesn't have raise a ValueError that
+    names the command line option they came from
+    '''
+    unknown = sorted(map(str, set(values) - set(record._fields)))
+    if unknown:
+        raise ValueError('unknown {} names: {} (expected some of {})'.format(
+            option, ', '.join(unknown), ', '.join(record._fields)))
+    return record(**{name: float(value) for name, value in values.items()})
+
+
+def compiled_loop(plant_name):
+    '''
+    Returns the compiled loop for the given plant class name, or None if the
+    plant doesn't have one or numba isn't installed
+    '''
+    if plant_name not in COMPILED_PLANTS:
+        return None
+    # Imported here so that runs which stay in Python don't import numba
     try:
-        sim.plant.animate_system()
-    except AttributeError:
-        pass
-
-
-def simulation_update(simulation, timestamp, output, args):
-    simulation.plant.update(output, duration=args.sampletime)
-    # Add a state reading to the delayed_states queue, which bumps an element
-    # off the front
-    simulation.delayed_states.append(simulation.plant.sensable_state)
-    # Make the simulation read the delayed state value
-    simulation.sensor_states.append(simulation.delayed_states[0])
-    # For the following values just append them to lists of values over time
-    simulation.timestamps.append(timestamp)
-    simulation.outputs.append(output)
-    simulation.plant_states.append(simulation.plant.sensable_state)
+        import compiled
+    except ImportError:
+        return None
+    return compiled.LOOPS.get(plant_name)
+
+
+def check_compiled(args):
+    '''
+    Runs args through both the Python loop and the compiled loop with the
+    same sensor noise, and raises ValueError if they don't produce the same
+    histories and final controller and plant states. Returns the compiled
+    simulation
+    '''
+    if compiled_loop(args.plant) is None:
+        raise ValueError('no compiled loop for {} (or numba is not '
+                         'installed)'.format(args.plant))
+    random_state = np.random.get_state()
+    expected = run_simulation(args, use_compiled=False)
+    np.random.set_state(random_state)
+    actual = run_simulation(args, use_compiled=True)
+
+    compared = [(field, getattr(expected, field), getattr(actual, field))
+                for field in ('timestamps', 'plant_states', 'sensor_states',
+                              'outputs', 'delayed_states')]
+    compared.append(('controller state', expected.controller.step_kernel()[0],
+                     actual.controller.step_kernel()[0]))
+    compared.append(('plant state', expected.plant.step_kernel()[0],
+                     actual.plant.step_kernel()[0]))
+    for name, expected_values, actual_values in compared:
+        if (expected_values.shape != actual_values.shape or
+                not np.allclose(expected_values, actual_values,
+                                rtol=1e-9, atol=1e-12)):
+            raise ValueError('compiled loop {} differ from the Python '
+                             'loop'.format(name))
+    return actual
 
 
 def plot_simulation(simulation, title):
@@ -175,6 +327,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '-p', '--pid',
         nargs=3,
+        type=float,
         metavar=('kp', 'ki', 'kd'),
         default=None,
         help='simulate a PID controller')
@@ -183,6 +336,12 @@ if __name__ == '__main__':
         '-v', '--verbose',
         action='store_true',
         help='be verbose')
+    parser.add_argument(
+        '--no-plot',
+        action='store_true',
+        default=bool(os.environ.get('SIM_NO_PLOT')),
+        help='only run the simulation, skipping all plots and animations'
+             ' (also set by a non-empty SIM_NO_PLOT environment variable)')
 
     parser.add_argument(
         '-s', '--setpoint',
@@ -236,6 +395,12 @@ if __name__ == '__main__':
              ' time, and the result will cap the output change each timestep.'
              ' If the output is m/s^2, the limit is, by definition, m/s^3')
 
+    parser.add_argument(
+        '--check-compiled',
+        action='store_true',
+        help='run the simulation through both the Python and the compiled'
+             ' loop and fail if their results differ')
+
     parser.add_argument(
         '--constant-values',
         default='{}',